@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
-import math
 import os
 import time
 import json
+import logging
 import argparse
-import requests
 import asyncio
 import threading
 import nest_asyncio
 import aiohttp
 import random
-from dotenv import load_dotenv
+import numpy as np
+import orjson
+from functools import lru_cache
+from dotenv import load_dotenv, set_key
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
@@ -22,6 +24,12 @@ from telegram.ext import (
 nest_asyncio.apply()
 load_dotenv()
 
+logging.basicConfig(
+    level=os.getenv("LOGLEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(message)s",
+)
+log = logging.getLogger("bot")
+
 YANDEX_API_KEY = os.getenv("YANDEX_MAPS_API_KEY")
 TG_TOKEN = os.getenv("TG_API_KEY")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
@@ -43,88 +51,206 @@ def load_json(path, default):
     except FileNotFoundError:
         return default
 
-USERS = load_json(USERS_FILE, [])
+USERS = set(load_json(USERS_FILE, []))
 PENDING = load_json(PENDING_FILE, {})
 KNOWN_USERS = load_json(KNOWN_FILE, {})
+# обратный индекс chat_id -> username, поддерживается вместе с KNOWN_USERS
+KNOWN_BY_ID = {cid: name for name, cid in KNOWN_USERS.items()}
 
 if not YANDEX_API_KEY:
     raise RuntimeError("Ошибка: переменная окружения YANDEX_MAPS_API_KEY не найдена в .env!")
 
 JSON_STORAGE = "accidents.json"
+
+# ключи ДТП храним в целых микроградусах (1e-6° ≈ 11 см): серверные
+# округления не плодят «новые» ключи для одного и того же события
+def _parse_accident_key(k):
+    a, b = k.split(",")
+    if "." in a or "." in b:
+        # старый формат с float-координатами
+        return round(float(a) * 1_000_000), round(float(b) * 1_000_000)
+    return int(a), int(b)
+
 if os.path.exists(JSON_STORAGE):
     with open(JSON_STORAGE, "r") as f:
-        CURRENT_ACCIDENTS = {tuple(map(float, k.split(","))): v for k, v in json.load(f).items()}
-    print(f"Загружено старых ДТП: {len(CURRENT_ACCIDENTS)}")
+        CURRENT_ACCIDENTS = {_parse_accident_key(k): v for k, v in json.load(f).items()}
+    log.info("Загружено старых ДТП: %d", len(CURRENT_ACCIDENTS))
 else:
     CURRENT_ACCIDENTS = {}
 
+# вместо переписывания всего снапшота каждый цикл копим дельты в
+# append-only лог; снапшот пересобирается при компакции и на выходе
+DELTA_LOG = "accidents.jsonl"
+_COMPACT_EVERY = 1000
+_delta_lines = 0
+
+if os.path.exists(DELTA_LOG):
+    with open(DELTA_LOG, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = orjson.loads(line)
+            except Exception:
+                # оборванная последняя запись после падения
+                continue
+            for lat, lon, desc in rec.get("+", []):
+                CURRENT_ACCIDENTS[(lat, lon)] = desc
+            for lat, lon in rec.get("-", []):
+                CURRENT_ACCIDENTS.pop((lat, lon), None)
+            _delta_lines += 1
+    if _delta_lines:
+        log.info("Проиграно дельт из %s: %d, актуальных ДТП: %d",
+                 DELTA_LOG, _delta_lines, len(CURRENT_ACCIDENTS))
+
 DEFAULT_ZOOM = 11
 DEFAULT_INTERVAL = 15
 
 def save_json(path, data):
-    with open(path, "w") as f:
+    # пишем во временный файл и атомарно подменяем, чтобы падение
+    # посреди записи не оставило битый JSON
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def _atomic_write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, path)
+
+def _append_delta(record: bytes):
+    global _delta_lines
+    with open(DELTA_LOG, "ab") as f:
+        f.write(record)
+    _delta_lines += 1
+
+def _compact_storage(accidents):
+    global _delta_lines
+    _atomic_write_json(
+        JSON_STORAGE,
+        {f"{k[0]},{k[1]}": v for k, v in accidents.items()},
+    )
+    open(DELTA_LOG, "wb").close()
+    _delta_lines = 0
+    log.info("Компакция: снапшот %s переписан, дельта-лог очищен", JSON_STORAGE)
+
+# отложенная запись: обработчики только помечают файл "грязным",
+# фоновая задача раз в _FLUSH_INTERVAL сбрасывает всё на диск одним махом
+_DIRTY = set()
+_FLUSH_INTERVAL = 0.5
+
+# снимки, а не живые структуры: воркер-поток не должен итерировать dict,
+# который обработчик может менять на event loop во время записи
+_DATA_SOURCES = {
+    USERS_FILE: lambda: sorted(USERS),
+    PENDING_FILE: lambda: dict(PENDING),
+    KNOWN_FILE: lambda: dict(KNOWN_USERS),
+}
+
+_FLUSH_LOCK = asyncio.Lock()
+
+def mark_dirty(path):
+    _DIRTY.add(path)
+
+async def flush_dirty():
+    # один писатель за раз: flusher и post_stop-хук делят имя path + ".tmp"
+    async with _FLUSH_LOCK:
+        for path in list(_DIRTY):
+            _DIRTY.discard(path)
+            data = _DATA_SOURCES[path]()
+            try:
+                await asyncio.to_thread(save_json, path, data)
+            except Exception as e:
+                # не даём ошибке диска убить flusher: пометим файл снова
+                # и повторим на следующем тике
+                log.error("Не удалось записать %s: %s — повтор на следующем тике", path, e)
+                _DIRTY.add(path)
+
+async def dirty_flusher():
+    while True:
+        await asyncio.sleep(_FLUSH_INTERVAL)
+        if _DIRTY:
+            await flush_dirty()
 
 def save_all():
-    save_json(USERS_FILE, USERS)
-    save_json(PENDING_FILE, PENDING)
-    save_json(KNOWN_FILE, KNOWN_USERS)
+    mark_dirty(USERS_FILE)
+    mark_dirty(PENDING_FILE)
+    mark_dirty(KNOWN_FILE)
 
 def update_env_admin(chat_id: int, username: str):
     """
-    Перезаписывает .env, добавляя или обновляя ADMIN_CHAT_ID.
-    Сохраняет другие переменные как есть.
+    Добавляет или обновляет ADMIN_CHAT_ID в .env точечной правкой,
+    не трогая остальные строки (комментарии и кавычки сохраняются).
     """
-    env_path = ".env"
-    env_data = {}
+    set_key(".env", "ADMIN_CHAT_ID", str(chat_id), quote_mode="never")
 
-    if os.path.exists(env_path):
-        with open(env_path, "r", encoding="utf-8") as f:
-            for line in f:
-                if "=" in line:
-                    key, value = line.strip().split("=", 1)
-                    env_data[key] = value
-
-    env_data["ADMIN_CHAT_ID"] = str(chat_id)
-
-    with open(env_path, "w", encoding="utf-8") as f:
-        for key, value in env_data.items():
-            f.write(f"{key}={value}\n")
-
-    print(f"[ENV] ADMIN_CHAT_ID={chat_id}")
+    log.info("[ENV] ADMIN_CHAT_ID=%s", chat_id)
 
+@lru_cache(maxsize=4096)
 def make_yandex_link(lat, lon):
     url = f"https://yandex.ru/maps/?ll={lon},{lat}&z=17"
     return f"[{lat}, {lon}]({url})"
 
-def latlon_to_tile(lat, lon, zoom):
-    lat_rad = math.radians(lat)
-    n = 2 ** zoom
+def _latlon_to_tile_arr(lat, lon, zoom):
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    n = 1 << zoom
+
+    x = ((lon + 180.0) * (n / 360.0)).astype(np.int64)
 
-    x = (lon + 180.0) / 360.0 * n
+    lat_rad = np.radians(lat)
+    y = ((1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi)
+         * (n / 2.0)).astype(np.int64)
 
-    a = math.tan(math.pi/4 + lat_rad/2)
-    y = (1 - math.log(a) / math.pi) / 2 * n
+    return x, y
 
+@lru_cache(maxsize=256)
+def _latlon_to_tile_scalar(lat, lon, zoom):
+    x, y = _latlon_to_tile_arr(lat, lon, zoom)
     return int(x), int(y)
 
-def get_yandex_layer_version(layer="trfe", lang="ru_RU"):
+def latlon_to_tile(lat, lon, zoom):
+    """
+    Переводит широту/долготу в индексы тайлов. Принимает как скаляры,
+    так и numpy-массивы координат (весь грид считается одним вызовом);
+    скалярные вызовы (углы области каждый цикл одни и те же) кэшируются.
+    """
+    if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+        return _latlon_to_tile_scalar(float(lat), float(lon), zoom)
+    return _latlon_to_tile_arr(lat, lon, zoom)
+
+_LAYER_VERSION = None
+_LAYER_VERSION_TS = 0.0
+_LAYER_TTL = 120
+
+async def get_yandex_layer_version(session, layer="trfe", lang="ru_RU"):
+    global _LAYER_VERSION, _LAYER_VERSION_TS
+
+    # Яндекс обновляет штамп слоя раз в несколько минут — кэшируем
+    if _LAYER_VERSION and time.monotonic() - _LAYER_VERSION_TS < _LAYER_TTL:
+        return _LAYER_VERSION
+
     url = (
         "https://api-maps.yandex.ru/services/coverage/v2/layers_stamps"
         f"?lang={lang}&l={layer}"
     )
     try:
-        resp = requests.get(url, timeout=5)
-        if resp.status_code != 200:
-            print(f"⚠ Ошибка API версии слоёв: HTTP {resp.status_code}")
-            return None
-        data = resp.json()
+        async with session.get(url, timeout=10) as resp:
+            if resp.status != 200:
+                log.warning("Ошибка API версии слоёв: HTTP %s", resp.status)
+                return None
+            data = await resp.json(content_type=None)
         if layer not in data or "version" not in data[layer]:
-            print(f"⚠ В ответе нет версии слоя {layer}: {data}")
+            log.warning("В ответе нет версии слоя %s: %s", layer, data)
             return None
-        return data[layer]["version"]
+        _LAYER_VERSION = data[layer]["version"]
+        _LAYER_VERSION_TS = time.monotonic()
+        return _LAYER_VERSION
     except Exception as e:
-        print(f"❌ Ошибка при получении версии слоя {layer}: {e}")
+        log.error("Ошибка при получении версии слоя %s: %s", layer, e)
         return None
 
 async def fetch_tile_json(session, x, y, z, version):
@@ -134,43 +260,46 @@ async def fetch_tile_json(session, x, y, z, version):
         f"&apikey={YANDEX_API_KEY}&callback=x_{x}_y_{y}_z_{z}_l_trje__t"
     )
 
-    # print(f"→ Скачиваем тайл: x={x}, y={y}, z={z}")
+    log.debug("Скачиваем тайл: x=%d, y=%d, z=%d", x, y, z)
 
     try:
         async with session.get(url, timeout=10) as resp:
             text = await resp.text()
 
-            # JSONP: ищем скобки
-            start = text.find("(")
-            end = text.rfind(");")
+            # JSONP-обёртка фиксирована: <callback>( ... );
+            prefix = f"x_{x}_y_{y}_z_{z}_l_trje__t("
 
-            if start == -1 or end == -1:
-                print(f"❌ Ошибка формата JSONP в тайле {x},{y},{z}")
+            if not text.startswith(prefix) or not text.endswith(");"):
+                log.error("Ошибка формата JSONP в тайле %d,%d,%d", x, y, z)
                 return None
 
-            json_text = text[start + 1:end]
-
-            return json.loads(json_text)
+            # отдаём сырой JSON: extract_accidents сам решит, парсить ли
+            return text[len(prefix):-2]
 
     except Exception as e:
-        print(f"❌ Ошибка при загрузке тайла {x},{y},{z}: {e}")
+        log.error("Ошибка при загрузке тайла %d,%d,%d: %s", x, y, z, e)
         return None
 
-def extract_accidents(data, lat_min, lon_min, lat_max, lon_max):
+def extract_accidents(raw, lat_min, lon_min, lat_max, lon_max):
     accidents = {}
+
+    # большинство тайлов пустые: проверка подстроки в C намного дешевле
+    # полного разбора JSON
+    if '"eventType"' not in raw:
+        return accidents
+
     try:
+        data = orjson.loads(raw)
         features = data.get("data", {}).get("features", [])
-        # print(f"   Найдено событий в тайле: {len(features)}")
         for f in features:
             if f["properties"]["eventType"] == 1:
                 lat, lon = f["geometry"]["coordinates"]
                 in_bounds = (lat_min <= lat <= lat_max) and (lon_min <= lon <= lon_max)
-                print(f"   * ДТП: {lat:.6f}, {lon:.6f} {'В пределах' if in_bounds else 'Вне границ'} "
-                      f"(границы: lat [{lat_min:.2f}-{lat_max:.2f}], lon [{lon_min:.2f}-{lon_max:.2f}])")
                 if in_bounds:
-                    accidents[(lat, lon)] = f["properties"]["description"]
+                    key = (round(lat * 1_000_000), round(lon * 1_000_000))
+                    accidents[key] = f["properties"]["description"]
     except Exception as e:
-        print("❌ Ошибка при обработке данных:", e)
+        log.error("Ошибка при обработке данных: %s", e)
     return accidents
 
 def get_admin_chat_id():
@@ -187,6 +316,13 @@ def normalize_username(u: str):
         return ""
     return u.lstrip("@").lower()
 
+# по одной блокировке на username: два быстрых /start или двойной клик
+# админа по inline-кнопке не должны дважды прогнать один и тот же путь
+_user_locks: dict[str, asyncio.Lock] = {}
+
+def _lock_for(username: str) -> asyncio.Lock:
+    return _user_locks.setdefault(username, asyncio.Lock())
+
 async def cmd_set_me_as_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global ADMIN_CHAT_ID
 
@@ -213,36 +349,38 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     username = normalize_username(user.username) or f"user_{chat_id}"
 
-    KNOWN_USERS[username] = chat_id
-    save_json(KNOWN_FILE, KNOWN_USERS)
-
-    if chat_id in USERS:
-        await update.message.reply_text("Вы уже подписаны на уведомления.")
-        return
-
-    if username in PENDING:
-        await update.message.reply_text("Ваша заявка уже в очереди — ожидайте одобрения администратора.")
-        return
-
-    PENDING[username] = chat_id
-    save_json(PENDING_FILE, PENDING)
-
-    admin_chat = get_admin_chat_id()
-    if admin_chat:
-        text = f"Пользователь @{username} запросил доступ к уведомлениям."
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve:{username}"),
-                InlineKeyboardButton(text="❌ Отклонить", callback_data=f"deny:{username}"),
-            ]
-        ])
-        try:
-            await context.bot.send_message(chat_id=admin_chat, text=text, reply_markup=keyboard)
-        except Exception as e:
-            print("Не удалось отправить уведомление админу:", e)
-    else:
-        await update.message.reply_text("Заявка принята, но администратор не указан — попробуйте позже.")
-        return
+    async with _lock_for(username):
+        KNOWN_USERS[username] = chat_id
+        KNOWN_BY_ID[chat_id] = username
+        mark_dirty(KNOWN_FILE)
+
+        if chat_id in USERS:
+            await update.message.reply_text("Вы уже подписаны на уведомления.")
+            return
+
+        if username in PENDING:
+            await update.message.reply_text("Ваша заявка уже в очереди — ожидайте одобрения администратора.")
+            return
+
+        PENDING[username] = chat_id
+        mark_dirty(PENDING_FILE)
+
+        admin_chat = get_admin_chat_id()
+        if admin_chat:
+            text = f"Пользователь @{username} запросил доступ к уведомлениям."
+            keyboard = InlineKeyboardMarkup([
+                [
+                    InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve:{username}"),
+                    InlineKeyboardButton(text="❌ Отклонить", callback_data=f"deny:{username}"),
+                ]
+            ])
+            try:
+                await context.bot.send_message(chat_id=admin_chat, text=text, reply_markup=keyboard)
+            except Exception as e:
+                log.warning("Не удалось отправить уведомление админу: %s", e)
+        else:
+            await update.message.reply_text("Заявка принята, но администратор не указан — попробуйте позже.")
+            return
 
     await update.message.reply_text("Заявка отправлена администратору. Ожидайте решения.")
 
@@ -256,7 +394,7 @@ async def cmd_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         message = "ТЕКУЩИЕ ДТП\n\n"
         message += "\n".join(
-            f"⚠️ {make_yandex_link(lat, lon)} — {desc}"
+            f"⚠️ {make_yandex_link(lat / 1e6, lon / 1e6)} — {desc}"
             for (lat, lon), desc in CURRENT_ACCIDENTS.items()
         )
     
@@ -272,24 +410,14 @@ async def cmd_access_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Только администратор может использовать эту команду.")
         return
 
-    try:
-        with open("known_users.json", "r") as f:
-            known = json.load(f)
-    except FileNotFoundError:
-        known = {}
-
     if not USERS:
         await update.message.reply_text("Нет ни одного подписанного пользователя.")
         return
 
     text = """📋 Список подписанных пользователей:\n\n"""
 
-    for uid in USERS:
-        username = None
-        for name, cid in known.items():
-            if cid == uid:
-                username = name
-                break
+    for uid in sorted(USERS):
+        username = KNOWN_BY_ID.get(uid)
 
         if username:
             text += f"""• @{username} — `{uid}`\n"""
@@ -314,16 +442,16 @@ async def cmd_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def approve_user(username: str, context: ContextTypes.DEFAULT_TYPE, by_admin: int):
     username = normalize_username(username)
-    if username not in PENDING:
-        return False, "Пользователь не в списке ожидания."
-    chat_id = PENDING.pop(username)
-    if chat_id not in USERS:
-        USERS.append(chat_id)
-    save_all()
+    async with _lock_for(username):
+        if username not in PENDING:
+            return False, "Пользователь не в списке ожидания."
+        chat_id = PENDING.pop(username)
+        USERS.add(chat_id)
+        save_all()
     try:
         await context.bot.send_message(chat_id=chat_id, text="Ваша заявка одобрена. Вы подписаны на уведомления.")
     except Exception as e:
-        print("Не удалось уведомить пользователя об одобрении:", e)
+        log.warning("Не удалось уведомить пользователя об одобрении: %s", e)
     try:
         await context.bot.send_message(chat_id=by_admin, text=f"Пользователь @{username} одобрен.")
     except Exception:
@@ -332,10 +460,11 @@ async def approve_user(username: str, context: ContextTypes.DEFAULT_TYPE, by_adm
 
 async def deny_user(username: str, context: ContextTypes.DEFAULT_TYPE, by_admin: int):
     username = normalize_username(username)
-    if username not in PENDING:
-        return False, "Пользователь не в списке ожидания."
-    chat_id = PENDING.pop(username)
-    save_all()
+    async with _lock_for(username):
+        if username not in PENDING:
+            return False, "Пользователь не в списке ожидания."
+        chat_id = PENDING.pop(username)
+        save_all()
     try:
         await context.bot.send_message(chat_id=chat_id, text="Ваша заявка отклонена администратором.")
     except Exception:
@@ -423,12 +552,19 @@ async def cmd_revoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("Пользователь не был в списке подписчиков.")
 
+NOTIFY_CONCURRENCY = 20  # держим ниже лимита Telegram (~30 msg/s на бота)
+
 async def send_notification(app, text: str):
-    for user_id in USERS:
-        try:
-            await app.bot.send_message(chat_id=user_id, text=text, parse_mode="Markdown")
-        except Exception as e:
-            print(f"Не удалось отправить сообщение {user_id}: {e}")
+    sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def _one(user_id):
+        async with sem:
+            try:
+                await app.bot.send_message(chat_id=user_id, text=text, parse_mode="Markdown")
+            except Exception as e:
+                log.warning("Не удалось отправить сообщение %s: %s", user_id, e)
+
+    await asyncio.gather(*(_one(user_id) for user_id in USERS))
 
 async def fetch_tiles_in_batches(session, coords, zoom, version):
     tiles_data = []
@@ -438,7 +574,7 @@ async def fetch_tiles_in_batches(session, coords, zoom, version):
         batch_coords = coords[i:i + BATCH_SIZE]
         batch_index = i // BATCH_SIZE + 1
 
-        print(f"[Пачка {batch_index}] {len(batch_coords)} запросов...")
+        log.info("[Пачка %d] %d запросов...", batch_index, len(batch_coords))
 
         # создаём задачи ТОЛЬКО для текущей пачки
         tasks = [
@@ -449,15 +585,15 @@ async def fetch_tiles_in_batches(session, coords, zoom, version):
         try:
             results = await asyncio.gather(*tasks, return_exceptions=True)
         except Exception as e:
-            print(f"❌ Ошибка batch gather: {e}")
+            log.error("Ошибка batch gather: %s", e)
             results = [None] * len(batch_coords)
 
         had_rate_limit = False
         processed_results = []
 
         for res in results:
-            # успешный JSON
-            if isinstance(res, dict):
+            # успешный ответ — сырой JSON тайла
+            if isinstance(res, str):
                 processed_results.append(res)
                 continue
 
@@ -467,9 +603,9 @@ async def fetch_tiles_in_batches(session, coords, zoom, version):
 
                 if status == 429:
                     had_rate_limit = True
-                    print("⚠️ Получен 429 — замедление.")
+                    log.warning("Получен 429 — замедление.")
                 elif 500 <= status < 600:
-                    print(f"⚠️ Серверная ошибка {status}, увеличиваем задержку.")
+                    log.warning("Серверная ошибка %s, увеличиваем задержку.", status)
                     had_rate_limit = True
 
             processed_results.append(None)
@@ -485,93 +621,126 @@ async def fetch_tiles_in_batches(session, coords, zoom, version):
         jitter = random.uniform(-RANDOM_JITTER, RANDOM_JITTER)
         sleep_time = max(0.1, delay + jitter)
 
-        print(f"⏳ Пауза {sleep_time:.2f} сек...")
+        log.debug("Пауза %.2f сек...", sleep_time)
         await asyncio.sleep(sleep_time)
 
     return tiles_data
 
-async def fetch_and_notify(app, args):
+async def poll_once(app, args, session):
     global CURRENT_ACCIDENTS
 
-    async with aiohttp.ClientSession() as session:
+    x1, y1 = latlon_to_tile(args.lat_min, args.lon_min, args.zoom)
+    x2, y2 = latlon_to_tile(args.lat_max, args.lon_max, args.zoom)
+
+    x_min, x_max = sorted((x1, x2))
+    y_min, y_max = sorted((y1, y2))
+
+    log.debug("Вычислены тайлы: x [%d, %d], y [%d, %d]", x_min, x_max, y_min, y_max)
+    log.debug("Границы области: lat [%.2f-%.2f], lon [%.2f-%.2f]",
+              args.lat_min, args.lat_max, args.lon_min, args.lon_max)
+
+    version = await get_yandex_layer_version(session)
+    if version is None:
+        # без версии тайлы вернут ошибки и все ДТП выглядели бы «разрешёнными»
+        raise RuntimeError("не удалось получить версию слоя")
+
+    # только coords — без задач
+    coords = [
+        (x, y)
+        for x in range(x_min, x_max + 1)
+        for y in range(y_min, y_max + 1)
+    ]
+
+    # получение JSON пачками
+    tiles_data = await fetch_tiles_in_batches(session, coords, args.zoom, version)
+
+    new_accidents = {}
+
+    # сопоставление 1:1
+    for (x, y), data in zip(coords, tiles_data):
+        if not data:
+            continue
+
+        accidents = extract_accidents(
+            data,
+            args.lat_min, args.lon_min,
+            args.lat_max, args.lon_max
+        )
+        new_accidents.update(accidents)
+
+    log.info("Общее количество ДТП в текущем цикле: %d", len(new_accidents))
+
+    # diff по ключам — одна операция над множествами вместо
+    # двух проходов с membership-проверками
+    appeared = new_accidents.keys() - CURRENT_ACCIDENTS.keys()
+    resolved = CURRENT_ACCIDENTS.keys() - new_accidents.keys()
+
+    if not appeared and not resolved:
+        # типичный «тихий» цикл: ключи не изменились, значит ни
+        # уведомлять, ни перезаписывать снапшот незачем
+        CURRENT_ACCIDENTS = new_accidents
+        log.debug("Изменений нет — уведомления и запись пропущены")
+        return
+
+    log.info("Зафиксировано %d новых и %d разрешённых ДТП",
+             len(appeared), len(resolved))
+
+    appeared_accidents = [
+        f"🆕 Новое ДТП: {make_yandex_link(lat / 1e6, lon / 1e6)}"
+        for (lat, lon) in appeared
+    ]
+    resolved_accidents = [
+        f"✅ ДТП разрешено: {make_yandex_link(lat / 1e6, lon / 1e6)}"
+        for (lat, lon) in resolved
+    ]
+
+    message = "НОВЫЕ СОБЫТИЯ\n\n"
+    message += "\n".join(appeared_accidents)
+    if appeared_accidents:
+        message += "\n\n"
+    message += "\n".join(resolved_accidents)
+
+    asyncio.create_task(send_notification(app, message))
+
+    # одна дельта-строка вместо полного снапшота (в отдельном потоке)
+    record = orjson.dumps({
+        "t": time.time(),
+        "+": [[lat, lon, new_accidents[(lat, lon)]] for (lat, lon) in appeared],
+        "-": [list(k) for k in resolved],
+    }) + b"\n"
+    await asyncio.to_thread(_append_delta, record)
+
+    log.debug("Дельта дописана в %s", DELTA_LOG)
+
+    CURRENT_ACCIDENTS = new_accidents
+
+    if _delta_lines >= _COMPACT_EVERY:
+        await asyncio.to_thread(_compact_storage, new_accidents)
+
+async def fetch_and_notify(app, args):
+    connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        headers={"User-Agent": "traffic-notify-bot/1.0"},
+    ) as session:
+
+        fail_streak = 0
 
         while True:
-            x1, y1 = latlon_to_tile(args.lat_min, args.lon_min, args.zoom)
-            x2, y2 = latlon_to_tile(args.lat_max, args.lon_max, args.zoom)
-
-            x_min, x_max = sorted((x1, x2))
-            y_min, y_max = sorted((y1, y2))
-
-            print(f"Вычислены тайлы: x [{x_min}, {x_max}], y [{y_min}, {y_max}]")
-            print(f"Границы области: lat [{args.lat_min:.2f}-{args.lat_max:.2f}], "
-                  f"lon [{args.lon_min:.2f}-{args.lon_max:.2f}]")
-
-            version = get_yandex_layer_version()
-
-            # только coords — без задач
-            coords = [
-                (x, y)
-                for x in range(x_min, x_max + 1)
-                for y in range(y_min, y_max + 1)
-            ]
-
-            # получение JSON пачками
-            tiles_data = await fetch_tiles_in_batches(session, coords, args.zoom, version)
-
-            new_accidents = {}
-
-            # сопоставление 1:1
-            for (x, y), data in zip(coords, tiles_data):
-                if not data:
-                    continue
-
-                accidents = extract_accidents(
-                    data,
-                    args.lat_min, args.lon_min,
-                    args.lat_max, args.lon_max
-                )
-                new_accidents.update(accidents)
-
-            print(f"Общее количество ДТП в текущем цикле: {len(new_accidents)}")
-
-            # новыe
-            appeared_accidents = [
-                f"🆕 Новое ДТП: {make_yandex_link(lat, lon)}"
-                for (lat, lon) in new_accidents
-                if (lat, lon) not in CURRENT_ACCIDENTS
-            ]
-
-            # исчезнувшие
-            resolved_accidents = [
-                f"✅ ДТП разрешено: {make_yandex_link(lat, lon)}"
-                for (lat, lon) in CURRENT_ACCIDENTS
-                if (lat, lon) not in new_accidents
-            ]
-
-            if appeared_accidents or resolved_accidents:
-                print(f"Зафиксировано {len(appeared_accidents)} новых и "
-                      f"{len(resolved_accidents)} разрешённых ДТП")
-
-                message = "НОВЫЕ СОБЫТИЯ\n\n"
-                message += "\n".join(appeared_accidents)
-                if appeared_accidents:
-                    message += "\n\n"
-                message += "\n".join(resolved_accidents)
-
-                asyncio.create_task(send_notification(app, message))
-
-            # запись
-            with open(JSON_STORAGE, "w") as f:
-                json.dump(
-                    {f"{k[0]},{k[1]}": v for k, v in new_accidents.items()},
-                    f, indent=2
-                )
-
-            print(f"Актуальный словарь сохранён: {JSON_STORAGE}")
-
-            CURRENT_ACCIDENTS = new_accidents
-
-            print(f"Ожидание {args.interval} секунд до следующего обновления...")
+            try:
+                await poll_once(app, args, session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # экспоненциальный backoff: не долбим API, пока оно лежит
+                fail_streak += 1
+                backoff = min(args.interval * 2 ** fail_streak, 300)
+                log.error("Сбой цикла опроса: %s — пауза %d сек", e, backoff)
+                await asyncio.sleep(backoff)
+                continue
+
+            fail_streak = 0
+            log.debug("Ожидание %d секунд до следующего обновления...", args.interval)
             await asyncio.sleep(args.interval)
 
 async def main():
@@ -587,7 +756,12 @@ async def main():
     args.lat_min, args.lat_max = sorted((args.lat_min, args.lat_max))
     args.lon_min, args.lon_max = sorted((args.lon_min, args.lon_max))
 
-    app = ApplicationBuilder().token(TG_TOKEN).build()
+    async def _flush_on_stop(app):
+        await flush_dirty()
+        # свежий снапшот на выходе, чтобы следующий старт не гнал весь лог
+        await asyncio.to_thread(_compact_storage, CURRENT_ACCIDENTS)
+
+    app = ApplicationBuilder().token(TG_TOKEN).post_stop(_flush_on_stop).build()
 
     # user commands
     app.add_handler(CommandHandler("start", cmd_start))
@@ -604,12 +778,13 @@ async def main():
     # callback handler for inline buttons
     app.add_handler(CallbackQueryHandler(callback_handler))
 
-    print("Телеграм бот запущен...")
+    log.info("Телеграм бот запущен...")
 
     async def start_fetch_loop():
         await fetch_and_notify(app, args)
 
     asyncio.create_task(start_fetch_loop())
+    asyncio.create_task(dirty_flusher())
 
     await app.run_polling()
 